@@ -0,0 +1,42 @@
+# Generated by Django 4.2 on 2026-10-15 03:44
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def backfill_due_date(apps, schema_editor):
+    Loan = apps.get_model('library', 'Loan')
+    loans = list(Loan.objects.filter(due_date__isnull=True).only('id', 'loan_date'))
+    for loan in loans:
+        loan.due_date = loan.loan_date + timedelta(days=14)
+    Loan.objects.bulk_update(loans, ['due_date'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='due_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(backfill_due_date, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='loan',
+            name='return_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(condition=models.Q(('is_returned', False)), fields=['due_date'], name='overdue_loans_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(fields=['book', 'member', 'is_returned'], name='loan_book_member_returned_idx'),
+        ),
+    ]
@@ -45,9 +45,17 @@ class Loan(models.Model):
     due_date = models.DateField(null=True)
     return_date = models.DateField(null=True)
     is_returned = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['due_date'], condition=models.Q(is_returned=False), name='overdue_loans_idx'),
+            models.Index(fields=['book', 'member', 'is_returned'], name='loan_book_member_returned_idx'),
+        ]
     
-    def save(self):
-        self.due_date = self.loan_date + timedelta(days=14)
+    def save(self, *args, **kwargs):
+        if self.due_date is None:
+            self.due_date = (self.loan_date or timezone.localdate()) + timedelta(days=14)
+        super().save(*args, **kwargs)
         
     def __str__(self):
         return f"{self.book.title} loaned to {self.member.user.username}"
@@ -0,0 +1,4 @@
+from rest_framework.pagination import PageNumberPagination
+
+class BookPagination(PageNumberPagination):
+    page_size = 10
@@ -1,17 +1,28 @@
 from celery import shared_task
-from celery.result import AsyncResult
-from celery.schedules import crontab
 from celery.utils.log import get_task_logger
-from library.util import get_overdue_loans
-from .models import Loan, Book
-from django.core.mail import send_mail
+from .models import Loan
+from django.core.mail import send_mail, get_connection, EmailMessage
+from django.db.models import Count, DateField, DurationField, ExpressionWrapper, F, Value
 from django.utils import timezone
 from django.conf import settings
-import logging
+from datetime import date
+from itertools import groupby
+from operator import itemgetter
 
 
 logger = get_task_logger(__name__)
 
+OVERDUE_BATCH_SIZE = 100
+
+OVERDUE_TEMPLATE = (
+    'Hello {username},\n\n'
+    'The following books on loan to you are overdue:\n'
+    '{books}\n\n'
+    'Please return them.'
+)
+
+OVERDUE_BOOK_TEMPLATE = '- "{book__title}" (due {due_date}, {days} days overdue)'
+
 
 @shared_task(
     bind=True,  # Allows access to task instance
@@ -19,7 +30,7 @@ logger = get_task_logger(__name__)
     default_retry_delay=60,  # Retry after 60 seconds
     autoretry_for=(Exception,)  # Automatically retry for these exceptions
 )
-def send_loan_notification(loan_id):
+def send_loan_notification(self, loan_id):
     
     try:
         loan = Loan.objects.get(id=loan_id)
@@ -35,18 +46,74 @@ def send_loan_notification(loan_id):
     except Loan.DoesNotExist:
         pass
     
-@shared_task
-def send_overdue_notification():
-    now = timezone.now()
-    overdue_loans = Loan.objects.filter(due_date__lt=now,is_returned=False).select_related('book','member')
-    for loan in overdue_loans:
-        member_email = loan.member.user.email
-        send_mail(
-            subject='Book Loaned Successfully',
-            message=f'Hello {loan.member.user.username},\n\nYour loan for the book with title "{loan.book.title}" is overdue.\nPlease return it.',
+@shared_task(
+    bind=True,
+    max_retries=3,
+    default_retry_delay=60,
+    autoretry_for=(Exception,)
+)
+def send_overdue_emails(self, member_ids, today):
+    # today comes from the scheduler so a retry after midnight uses the same cutoff
+    today = date.fromisoformat(today)
+    overdue_loans = Loan.objects.filter(
+        member_id__in=member_ids, due_date__lt=today, is_returned=False
+    ).annotate(
+        days_overdue=ExpressionWrapper(Value(today, output_field=DateField()) - F('due_date'), output_field=DurationField())
+    ).values(
+        'member_id', 'due_date', 'days_overdue', 'book__title', 'member__user__username', 'member__user__email'
+    ).order_by('member_id', 'due_date')
+    messages = []
+    for member_id, member_loans in groupby(overdue_loans, key=itemgetter('member_id')):
+        member_loans = list(member_loans)
+        lines = []
+        for loan in member_loans:
+            loan['days'] = loan['days_overdue'].days
+            lines.append(OVERDUE_BOOK_TEMPLATE.format_map(loan))
+        member = member_loans[0]
+        messages.append((member_id, EmailMessage(
+            subject='Overdue Books',
+            body=OVERDUE_TEMPLATE.format(username=member['member__user__username'], books='\n'.join(lines)),
             from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[member_email],
-            fail_silently=False,
-        )
-    
-    
\ No newline at end of file
+            to=[member['member__user__email']],
+        )))
+    if not messages:
+        return
+    failed_ids = []
+    # One SMTP connection for the whole batch; a failed send only retries that member
+    connection = get_connection(fail_silently=False)
+    connection.open()
+    try:
+        for member_id, message in messages:
+            try:
+                connection.send_messages([message])
+            except Exception:
+                logger.exception('Failed to send overdue notification to member %s', member_id)
+                failed_ids.append(member_id)
+    finally:
+        # Every message has been handed off by now; an error on QUIT must not resend the batch
+        try:
+            connection.close()
+        except Exception:
+            logger.exception('Failed to close SMTP connection')
+    if failed_ids:
+        raise self.retry(args=[failed_ids, today.isoformat()])
+
+@shared_task
+def check_overdue_loans():
+    today = timezone.localdate()
+    # One grouped query gives both the members to notify and the loan total
+    overdue_members = list(
+        Loan.objects.filter(due_date__lt=today,is_returned=False)
+        .values_list('member_id')
+        .annotate(loans=Count('id'))
+        .order_by('member_id')
+    )
+    if not overdue_members:
+        return {'total_overdue_loans': 0, 'notifications_sent': 0}
+    total_overdue = sum(loans for _, loans in overdue_members)
+    member_ids = [member_id for member_id, _ in overdue_members]
+    # Dispatch members in batches so each subtask reuses one SMTP connection
+    for start in range(0, len(member_ids), OVERDUE_BATCH_SIZE):
+        send_overdue_emails.delay(member_ids[start:start + OVERDUE_BATCH_SIZE], today.isoformat())
+    logger.info('Dispatched %d overdue notifications for %d loans', len(member_ids), total_overdue)
+    return {'total_overdue_loans': total_overdue, 'notifications_sent': len(member_ids)}
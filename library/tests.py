@@ -1,3 +1,266 @@
-from django.test import TestCase
+from datetime import timedelta
+from smtplib import SMTPServerDisconnected
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import Retry
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import Author, Book, Member, Loan
+from .tasks import check_overdue_loans, send_loan_notification, send_overdue_emails
+
+
+def create_member(username):
+    return Member.objects.create(user=User.objects.create(username=username, email=f'{username}@example.com'))
+
+
+class LibraryTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.today = timezone.localdate()
+        self.author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        self.book = Book.objects.create(title='The Dispossessed', author=self.author, isbn='9780061054884', genre='sci-fi')
+        self.member = create_member('alice')
+
+    def create_loan(self, member=None, book=None, days_overdue=0, **kwargs):
+        return Loan.objects.create(
+            book=book or self.book,
+            member=member or self.member,
+            due_date=self.today - timedelta(days=days_overdue),
+            **kwargs
+        )
+
+
+class LoanModelTests(LibraryTestCase):
+    def test_create_sets_due_date(self):
+        loan = Loan.objects.create(book=self.book, member=self.member)
+        loan.refresh_from_db()
+        self.assertEqual(loan.due_date, self.today + timedelta(days=14))
+
+
+class BookLoanTests(LibraryTestCase):
+    def loan(self, book_id, member_id):
+        return self.client.post(f'/api/books/{book_id}/loan/', {'member_id': member_id}, format='json')
+
+    def test_loan_decrements_available_copies(self):
+        response = self.loan(self.book.id, self.member.id)
+        self.assertEqual(response.status_code, 201)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 0)
+        loan = Loan.objects.get()
+        self.assertEqual(loan.due_date, self.today + timedelta(days=14))
+
+    def test_loan_last_copy_only_once(self):
+        self.assertEqual(self.loan(self.book.id, self.member.id).status_code, 201)
+        response = self.loan(self.book.id, create_member('bob').id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'No available copies.'})
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 0)
+        self.assertEqual(Loan.objects.count(), 1)
+
+    def test_loan_unknown_book(self):
+        response = self.loan(9999, self.member.id)
+        self.assertEqual(response.status_code, 404)
+
+    def test_loan_non_numeric_book_id(self):
+        response = self.loan('abc', self.member.id)
+        self.assertEqual(response.status_code, 404)
+
+    def test_loan_notification_sent_after_commit(self):
+        with mock.patch.object(send_loan_notification, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self.loan(self.book.id, self.member.id)
+        self.assertEqual(len(callbacks), 1)
+        delay.assert_called_once_with(Loan.objects.get().id)
+
+    def test_loan_notification_not_sent_on_failure(self):
+        self.book.available_copies = 0
+        self.book.save()
+        with mock.patch.object(send_loan_notification, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self.assertEqual(self.loan(self.book.id, self.member.id).status_code, 400)
+                self.assertEqual(self.loan(9999, self.member.id).status_code, 404)
+                self.assertEqual(self.loan(self.book.id, 9999).status_code, 400)
+        self.assertEqual(callbacks, [])
+        delay.assert_not_called()
+
+    def test_loan_unknown_member_keeps_copies(self):
+        response = self.loan(self.book.id, 9999)
+        self.assertEqual(response.status_code, 400)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 1)
+
+    def test_return_increments_available_copies(self):
+        self.loan(self.book.id, self.member.id)
+        response = self.client.post(f'/api/books/{self.book.id}/return_book/', {'member_id': self.member.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 1)
+        loan = Loan.objects.get()
+        self.assertTrue(loan.is_returned)
+        self.assertEqual(loan.return_date, self.today)
+
+    def test_return_without_active_loan(self):
+        response = self.client.post(f'/api/books/{self.book.id}/return_book/', {'member_id': self.member.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 1)
+
+    def test_return_unknown_book(self):
+        for book_id in (9999, 'abc'):
+            with self.subTest(book_id=book_id):
+                response = self.client.post(f'/api/books/{book_id}/return_book/', {'member_id': self.member.id}, format='json')
+                self.assertEqual(response.status_code, 404)
+
+
+class OverdueLoanTaskTests(LibraryTestCase):
+    def test_nothing_overdue_returns_early(self):
+        self.create_loan(days_overdue=-1)
+        self.create_loan(days_overdue=3, is_returned=True)
+        with mock.patch.object(send_overdue_emails, 'delay') as delay:
+            result = check_overdue_loans()
+        self.assertEqual(result, {'total_overdue_loans': 0, 'notifications_sent': 0})
+        delay.assert_not_called()
+
+    def test_members_dispatched_in_batches(self):
+        bob, carol = create_member('bob'), create_member('carol')
+        self.create_loan(days_overdue=3)
+        self.create_loan(days_overdue=1)
+        self.create_loan(member=bob, days_overdue=2)
+        self.create_loan(member=carol, days_overdue=5)
+        with mock.patch('library.tasks.OVERDUE_BATCH_SIZE', 2), \
+                mock.patch.object(send_overdue_emails, 'delay') as delay:
+            result = check_overdue_loans()
+        self.assertEqual(result, {'total_overdue_loans': 4, 'notifications_sent': 3})
+        today = self.today.isoformat()
+        self.assertEqual(delay.call_args_list, [
+            mock.call([self.member.id, bob.id], today),
+            mock.call([carol.id], today),
+        ])
+
+    def test_one_email_per_member(self):
+        second_book = Book.objects.create(title='The Lathe of Heaven', author=self.author, isbn='9781416556961', genre='sci-fi')
+        bob = create_member('bob')
+        self.create_loan(days_overdue=3)
+        self.create_loan(book=second_book, days_overdue=1)
+        self.create_loan(member=bob, days_overdue=2)
+        send_overdue_emails([self.member.id, bob.id], self.today.isoformat())
+        self.assertEqual(len(mail.outbox), 2)
+        alice_email, bob_email = mail.outbox
+        self.assertEqual(alice_email.to, ['alice@example.com'])
+        self.assertIn('"The Dispossessed" (due', alice_email.body)
+        self.assertIn('3 days overdue', alice_email.body)
+        self.assertIn('"The Lathe of Heaven" (due', alice_email.body)
+        self.assertEqual(bob_email.to, ['bob@example.com'])
+
+    def test_no_email_when_loans_returned(self):
+        self.create_loan(days_overdue=3, is_returned=True)
+        with mock.patch('library.tasks.get_connection') as get_connection:
+            send_overdue_emails([self.member.id], self.today.isoformat())
+        get_connection.assert_not_called()
+
+    def test_failed_send_retries_only_that_member(self):
+        bob = create_member('bob')
+        self.create_loan(days_overdue=3)
+        self.create_loan(member=bob, days_overdue=2)
+        smtp = mock.MagicMock()
+
+        def send_messages(messages):
+            if messages[0].to == ['bob@example.com']:
+                raise ConnectionError('SMTP send failed')
+            return 1
+
+        smtp.send_messages.side_effect = send_messages
+        with mock.patch('library.tasks.get_connection', return_value=smtp), \
+                mock.patch.object(send_overdue_emails, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                send_overdue_emails([self.member.id, bob.id], self.today.isoformat())
+        self.assertEqual(smtp.send_messages.call_count, 2)
+        retry.assert_called_once_with(args=[[bob.id], self.today.isoformat()])
+        smtp.close.assert_called_once_with()
+
+    def test_close_error_does_not_resend_batch(self):
+        self.create_loan(days_overdue=3)
+        smtp = mock.MagicMock()
+        smtp.close.side_effect = SMTPServerDisconnected('QUIT failed')
+        with mock.patch('library.tasks.get_connection', return_value=smtp), \
+                mock.patch.object(send_overdue_emails, 'retry') as retry:
+            send_overdue_emails([self.member.id], self.today.isoformat())
+        smtp.send_messages.assert_called_once()
+        retry.assert_not_called()
+
+
+class ExtendDueDateTests(LibraryTestCase):
+    def extend(self, loan, data):
+        return self.client.post(f'/api/loans/{loan.id}/extend_due_date/', data, format='json')
+
+    def test_extend_active_loan(self):
+        loan = self.create_loan(days_overdue=-2)
+        response = self.extend(loan, {'additional_days': 3})
+        self.assertEqual(response.status_code, 200)
+        loan.refresh_from_db()
+        self.assertEqual(loan.due_date, self.today + timedelta(days=5))
+
+    def test_overdue_loan_cannot_be_extended(self):
+        loan = self.create_loan(days_overdue=1)
+        response = self.extend(loan, {'additional_days': 3})
+        self.assertEqual(response.status_code, 400)
+        loan.refresh_from_db()
+        self.assertEqual(loan.due_date, self.today - timedelta(days=1))
+
+    def test_returned_loan_cannot_be_extended(self):
+        loan = self.create_loan(days_overdue=-2, is_returned=True)
+        self.assertEqual(self.extend(loan, {'additional_days': 3}).status_code, 400)
+
+    def test_invalid_additional_days(self):
+        loan = self.create_loan(days_overdue=-2)
+        for data in ({}, {'additional_days': 'soon'}, {'additional_days': 0}):
+            with self.subTest(data=data):
+                self.assertEqual(self.extend(loan, data).status_code, 400)
+        loan.refresh_from_db()
+        self.assertEqual(loan.due_date, self.today + timedelta(days=2))
+
+
+class TopActiveMembersTests(LibraryTestCase):
+    def test_top_active_members(self):
+        members = [self.member] + [create_member(f'member{i}') for i in range(5)]
+        for i, member in enumerate(members):
+            for _ in range(1 if i else 3):
+                self.create_loan(member=member)
+        self.create_loan(member=members[1], is_returned=True)
+        response = self.client.get('/api/members/top_active/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0], {
+            'id': self.member.id, 'username': 'alice', 'email': 'alice@example.com', 'active_loans': 3,
+        })
+        # Ties on active loans come back in id order
+        self.assertEqual([row['id'] for row in response.data], [member.id for member in members[:5]])
+        self.assertEqual([row['active_loans'] for row in response.data], [3, 1, 1, 1, 1])
+
+
+class DueDateBackfillMigrationTests(TransactionTestCase):
+    migrate_from = [('library', '0001_initial')]
+    migrate_to = [('library', '0002_loan_due_date_alter_loan_return_date_and_more')]
+
+    def test_existing_loans_get_due_date(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        old_apps = executor.loader.project_state(self.migrate_from).apps
+        author = old_apps.get_model('library', 'Author').objects.create(first_name='Ursula', last_name='Le Guin')
+        book = old_apps.get_model('library', 'Book').objects.create(title='The Dispossessed', author=author, isbn='9780061054884')
+        user = old_apps.get_model('auth', 'User').objects.create(username='alice')
+        member = old_apps.get_model('library', 'Member').objects.create(user_id=user.id)
+        loan = old_apps.get_model('library', 'Loan').objects.create(book=book, member=member)
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.migrate_to)
+        new_apps = executor.loader.project_state(self.migrate_to).apps
+        loan = new_apps.get_model('library', 'Loan').objects.get(pk=loan.pk)
+        self.assertEqual(loan.due_date, loan.loan_date + timedelta(days=14))
@@ -6,6 +6,8 @@ from datetime import timedelta
 from rest_framework.decorators import action,api_view
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import Count, F
 from .tasks import send_loan_notification
 
 class AuthorViewSet(viewsets.ModelViewSet):
@@ -13,29 +15,41 @@ class AuthorViewSet(viewsets.ModelViewSet):
     serializer_class = AuthorSerializer
 
 class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.all()
+    queryset = Book.objects.select_related('author')
     serializer_class = BookSerializer
+    # The loan actions filter on pk directly, so let the router 404 non-numeric ids
+    lookup_value_regex = r'\d+'
 
     @action(detail=True, methods=['post'])
     def loan(self, request, pk=None):
-        book = self.get_object()
-        if book.available_copies < 1:
-            return Response(
-                {'error': 'No available copies.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
         member_id = request.data.get('member_id')
-        try:
-            member = Member.objects.get(id=member_id)
-        except Member.DoesNotExist:
+        if not Member.objects.filter(id=member_id).exists():
             return Response(
                 {'error': 'Member does not exist.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        loan = Loan.objects.create(book=book, member=member)
-        book.available_copies -= 1
-        book.save()
-        send_loan_notification.delay(loan.id)
+        with transaction.atomic():
+            # Check and decrement in one conditional UPDATE so concurrent loans can't oversell;
+            # the UPDATE holds the book row lock until the loan is committed
+            updated = Book.objects.filter(pk=pk, available_copies__gte=1).update(
+                available_copies=F('available_copies') - 1
+            )
+            if updated == 0:
+                if not Book.objects.filter(pk=pk).exists():
+                    return Response(
+                        {'error': 'Book does not exist.'},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                return Response(
+                    {'error': 'No available copies.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            today = timezone.localdate()
+            loan = Loan.objects.create(
+                book_id=pk, member_id=member_id, due_date=today + timedelta(days=14)
+            )
+            # Enqueue only once the loan is committed so the worker can always see it
+            transaction.on_commit(lambda: send_loan_notification.delay(loan.id))
         return Response(
             {'status': 'Book loaned successfully.'},
             status=status.HTTP_201_CREATED
@@ -43,20 +57,21 @@ class BookViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post'])
     def return_book(self, request, pk=None):
-        book = self.get_object()
         member_id = request.data.get('member_id')
-        try:
-            loan = Loan.objects.get(
-                book=book, member__id=member_id, is_returned=False)
-        except Loan.DoesNotExist:
-            return Response(
-                {'error': 'Active loan does not exist.'},
-                status=status.HTTP_400_BAD_REQUEST)
-        loan.is_returned = True
-        loan.return_date = timezone.now().date()
-        loan.save()
-        book.available_copies += 1
-        book.save()
+        with transaction.atomic():
+            updated = Loan.objects.filter(
+                book_id=pk, member_id=member_id, is_returned=False
+            ).update(is_returned=True, return_date=timezone.localdate())
+            if updated == 0:
+                if not Book.objects.filter(pk=pk).exists():
+                    return Response(
+                        {'error': 'Book does not exist.'},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                return Response(
+                    {'error': 'Active loan does not exist.'},
+                    status=status.HTTP_400_BAD_REQUEST)
+            Book.objects.filter(pk=pk).update(available_copies=F('available_copies') + 1)
         return Response(
             {'status': 'Book returned successfully.'},
             status=status.HTTP_200_OK)
@@ -65,30 +80,47 @@ class MemberViewSet(viewsets.ModelViewSet):
     queryset = Member.objects.all()
     serializer_class = MemberSerializer
 
+    @action(detail=False, methods=['get'])
+    def top_active(self, request):
+        top_members = (
+            Member.objects.filter(loans__is_returned=False)
+            .values('id')
+            .annotate(username=F('user__username'), email=F('user__email'), active_loans=Count('loans'))
+            .order_by('-active_loans', 'id')[:5]
+        )
+        return Response(list(top_members), status=status.HTTP_200_OK)
+
 class LoanViewSet(viewsets.ModelViewSet):
-    queryset = Loan.objects.all()
+    queryset = Loan.objects.select_related('book__author', 'member__user')
     serializer_class = LoanSerializer
     
     @action(detail=True, methods = ['POST'])
     def extend_due_date(self, request, pk=None):
         loan = self.get_object()
-        if not loan.is_returned and loan.due_date < timezone.now():
-            additional_days = request.data.get('additional_days')
-            
-            if additional_days < 1:
-                return Response(
-                    {'status': 'Invalid additional days, there should be greater than 0'},
-                    status = status.HTTP_400_BAD_REQUEST
-                )
-            
-            loan.due_date = loan.due_date + timedelta(days=additional_days)
-            loan.save()
-            
+        if loan.is_returned:
             return Response(
-                {'status': 'loan extended successfully.'},
-            status=status.HTTP_200_OK)
-        if loan.due_date < timezone.now():
+                {'status': 'loan already returned.'},
+                status = status.HTTP_400_BAD_REQUEST
+            )
+        if loan.due_date < timezone.localdate():
             return Response(
                 {'status': 'loan already ovedue,'},
                 status = status.HTTP_400_BAD_REQUEST
-            )
\ No newline at end of file
+            )
+        try:
+            additional_days = int(request.data.get('additional_days'))
+        except (TypeError, ValueError):
+            additional_days = 0
+        
+        if additional_days < 1:
+            return Response(
+                {'status': 'Invalid additional days, there should be greater than 0'},
+                status = status.HTTP_400_BAD_REQUEST
+            )
+        
+        loan.due_date = loan.due_date + timedelta(days=additional_days)
+        loan.save(update_fields=['due_date'])
+        
+        return Response(
+            {'status': 'loan extended successfully.'},
+        status=status.HTTP_200_OK)